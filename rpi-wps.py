@@ -1,12 +1,16 @@
 import serial
 import time
-import csv
 import logging
+import math
+import os
+import signal
 
-from openpyxl import Workbook, load_workbook
-from openpyxl.chart import LineChart, Reference
+import xlsxwriter
+from array import array
+from itertools import compress
 from pathlib import Path
-from collections import defaultdict
+from queue import Queue
+from threading import Thread
 
 # ========================
 # Configuration Constants
@@ -15,6 +19,26 @@ UART_PORT = '/dev/ttyS0'      # UART port on Raspberry Pi
 BAUDRATE = 9600               # Communication speed
 SAVE_INTERVAL = 10            # Seconds between writes
 FILENAME_PREFIX = "pressure"  # Base name for log files
+WRITE_QUEUE_SIZE = 2          # Pending saves before readings are held back in the buffer
+
+# ========================
+# Minute Aggregation State
+# ========================
+# Running sum and count per minute of the day, so averages never require a rescan of
+# the raw data. Fixed size (~17 KB) regardless of the sample rate.
+MINUTES_PER_DAY = 24 * 60
+minute_sums = array('d', [0.0]) * MINUTES_PER_DAY
+minute_counts = array('I', [0]) * MINUTES_PER_DAY
+minute_date = ""                     # YYYY-MM-DD the minute buckets belong to
+minute_date_bytes = b""              # minute_date as bytes, to compare with reading timestamps
+MINUTE_LABELS = [f"{m // 60:02d}:{m % 60:02d}" for m in range(MINUTES_PER_DAY)]  # HH:MM per slot
+
+# ========================
+# Reading Buffer
+# ========================
+# CSV rows formatted as readings arrive, written out in one piece at the next save
+csv_payload = bytearray()
+buf_len = 0                          # number of readings in csv_payload
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,14 +46,6 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # ========================
 # Utility Functions
 # ========================
-def is_float(value: str) -> bool:
-    """Check if a string can be converted to a float."""
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
-
 def get_usb_mount_point():
     """Return the first USB mount point under /media/pi/, or None if not found."""
     base = Path("/media/pi")
@@ -39,124 +55,303 @@ def get_usb_mount_point():
                 return sub
     return None
 
-def get_daily_filename(extension: str):
-    today_str = time.strftime("%Y-%m-%d")
+_usb_cache = {'mount': None, 'checked_day': -1}
+
+def get_usb_mount_point_cached(day: int):
+    """Return the USB mount point, probing /media/pi/ only once per local day."""
+    if day != _usb_cache['checked_day']:
+        _usb_cache['mount'] = get_usb_mount_point()
+        _usb_cache['checked_day'] = day
+    return _usb_cache['mount']
+
+_last_sec = -1  # epoch second of the cached timestamp
+_last_ts = ""   # cached "YYYY-MM-DD HH:MM:SS" for _last_sec
+_last_ts_bytes = b""  # _last_ts encoded once, for the CSV
+_tz_off = 0     # local UTC offset in seconds for _last_sec (follows DST)
+
+def _update_time_cache(now: int):
+    """Refresh the cached timestamp and UTC offset for epoch second `now`."""
+    global _last_sec, _last_ts, _last_ts_bytes, _tz_off
+    local = time.localtime(now)
+    _last_sec = now
+    _last_ts = time.strftime("%Y-%m-%d %H:%M:%S", local)
+    _last_ts_bytes = _last_ts.encode('ascii')
+    _tz_off = local.tm_gmtoff
+
+def _refresh_time_cache() -> int:
+    """Return the current epoch second, refreshing the time cache if the second changed."""
+    now = int(time.time())
+    if now != _last_sec:
+        _update_time_cache(now)
+    return now
+
+def get_timestamp() -> str:
+    """Return the local time as YYYY-MM-DD HH:MM:SS, calling strftime at most once per second."""
+    _refresh_time_cache()
+    return _last_ts
+
+def get_timestamp_bytes() -> bytes:
+    """Return the cached timestamp as ASCII bytes, ready to be written to the CSV."""
+    _refresh_time_cache()
+    return _last_ts_bytes
+
+def get_local_day() -> int:
+    """Return the number of local days since the epoch."""
+    now = _refresh_time_cache()
+    return (now + _tz_off) // 86400
+
+def get_next_midnight() -> float:
+    """Return the epoch time of the next local midnight (DST-aware via mktime)."""
+    local = time.localtime()
+    return time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+def get_previous_date() -> str:
+    """Return yesterday's local date as YYYY-MM-DD."""
+    local = time.localtime()
+    noon = time.mktime((local.tm_year, local.tm_mon, local.tm_mday - 1, 12, 0, 0, 0, 0, -1))
+    return time.strftime("%Y-%m-%d", time.localtime(noon))
+
+def get_daily_filename(extension: str, date: str = None):
+    today_str = date or get_timestamp()[:10]
     filename = f"{FILENAME_PREFIX}_{today_str}.{extension}"
     return filename
 
-def get_output_paths(extension: str) -> list[Path]:
-    """Generate a filename based on today's date and given extension, in local path."""
-    filename = get_daily_filename(extension)
+def get_output_paths(extension: str, day: int, date: str = None) -> list[Path]:
+    """Generate a filename based on today's (or the given) date and extension, in local path."""
+    filename = get_daily_filename(extension, date)
     paths = [str(Path.cwd() / filename)]
-    usb_mount = get_usb_mount_point()
+    usb_mount = get_usb_mount_point_cached(day)
     if usb_mount:
         paths.append(str(usb_mount / filename))
     return paths
 
-def initialize_excel(file_path: str):
-    """Create a new Excel file with headers and empty chart area."""
-    logger.info(f"Initializing Excel file: {file_path}")
-    if not Path(file_path).exists():
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Data"
-        # Main raw data table headers
-        ws.append(["Timestamp", "Pressure (bar)"])
-        # Minute averages header start at col D (4)
-        ws.cell(row=1, column=4, value="Minute")
-        ws.cell(row=1, column=5, value="Average Pressure (bar)")
-        
-        wb.save(file_path)
-
-def load_excel(file_path: str):
-    """Load an existing Excel file and return workbook and active sheet."""
-    logger.info(f"Loading Excel file: {file_path}")
-    wb = load_workbook(file_path)
-    ws = wb.active
-    return wb, ws
+def save_excel(file_paths: list[str], minute_rows: list):
+    """
+    Write the daily Excel summary (minute averages and chart) in a single streaming pass.
+    Each path is written independently, so a failing USB drive cannot cost the local copy.
+    """
+    if not minute_rows:
+        return
+    for path in file_paths:
+        logger.info(f"Writing Excel summary: {path}")
+        try:
+            wb = xlsxwriter.Workbook(path, {'constant_memory': True})
+            ws = wb.add_worksheet("Minute Averages")
+            write_minute_table(wb, ws, minute_rows)
+            wb.close()
+        except Exception:
+            logger.exception(f"Failed to write Excel summary: {path}")
 
 def initialize_csv(file_path: str):
     """Create a new CSV file with headers if it doesn't exist."""
     logger.info(f"Initializing CSV file: {file_path}")
     if not Path(file_path).exists():
-        with open(file_path, mode='w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["Timestamp", "Pressure (bar)"])
+        with open(file_path, mode='wb') as f:
+            f.write(b"Timestamp,Pressure (bar)\n")
 
-def append_csv(file_path: str, rows: list):
-    """Append multiple rows to a CSV file."""
-    with open(file_path, mode='a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerows(rows)
+def open_csv_fds(file_paths: list[str]) -> dict[str, int]:
+    """
+    Open the CSV files as raw append-only descriptors; they stay open until the daily rollover.
+    O_DSYNC makes each write reach the storage before returning, so a power cut loses at most
+    the readings still in memory.
+    """
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_DSYNC
+    return {path: os.open(path, flags, 0o644) for path in file_paths}
+
+def close_csv_fds(csv_fds: dict[str, int]):
+    """Close all CSV file descriptors."""
+    for path, fd in csv_fds.items():
+        try:
+            os.close(fd)
+        except OSError as e:
+            logger.error(f"Failed to close CSV file {path}: {e}")
 
-def update_minute_averages_table(ws):
+def format_csv_row(timestamp: bytes, value: float) -> bytes:
+    """Format a reading as a CSV line. The schema is fixed, so no quoting is needed."""
+    return b"%s,%.3f\n" % (timestamp, value)
+
+def append_csv(csv_fds: dict[str, int], payload: bytes):
     """
-    Calculate minute averages from raw data and write them to columns D and E.
-    Format for minute: YYYY-MM-DD HH:MM (no seconds)
+    Append already formatted CSV rows to every open CSV file, normally with one write() each.
+    A failing file (e.g. a removed USB drive) is logged and does not stop the others.
     """
-    # Read all raw timestamps and pressures from columns A and B
-    raw_data = []
-    for row in ws.iter_rows(min_row=2, max_col=2, values_only=True):
-        if row[0] is None or row[1] is None:
-            continue
-        raw_data.append(row)
-    
-    if not raw_data:
+    for path, fd in csv_fds.items():
+        view = memoryview(payload)
+        try:
+            while view:
+                view = view[os.write(fd, view):]
+        except OSError as e:
+            logger.error(f"Failed to append to CSV file {path}: {e}")
+
+def buffer_reading(timestamp: bytes, value: float):
+    """Handle a reading in a single step: append its CSV row and update its minute bucket."""
+    global buf_len
+    csv_payload.extend(format_csv_row(timestamp, value))
+    add_reading(timestamp, value)
+    buf_len += 1
+
+def drain_readings() -> bytes:
+    """Return the CSV rows buffered since the last save and empty the buffer."""
+    global buf_len
+    payload = bytes(csv_payload)
+    csv_payload.clear()
+    buf_len = 0
+    return payload
+
+def minute_of_day(timestamp: bytes) -> int:
+    """Return the minute index (0-1439) of a YYYY-MM-DD HH:MM:SS timestamp."""
+    return int(timestamp[11:13]) * 60 + int(timestamp[14:16])
+
+def add_reading(timestamp: bytes, value: float):
+    """Accumulate a reading into its minute bucket."""
+    m = minute_of_day(timestamp)
+    minute_sums[m] += value
+    minute_counts[m] += 1
+
+def load_minute_state(file_path: str, date: str):
+    """Reset the minute buckets for `date` and rebuild them from the readings already logged to a CSV file."""
+    global minute_date, minute_date_bytes
+    minute_date = date
+    minute_date_bytes = date.encode('ascii')
+    minute_sums[:] = array('d', [0.0]) * MINUTES_PER_DAY
+    minute_counts[:] = array('I', [0]) * MINUTES_PER_DAY
+    if not Path(file_path).exists():
         return
-    
-    # Group values by minute
-    grouped = defaultdict(list)
-    for ts_str, pressure in raw_data:
-        # Truncate seconds: keep YYYY-MM-DD HH:MM
-        minute_str = ts_str[:16]
-        grouped[minute_str].append(pressure)
-    
-    # Clear previous minute averages (rows 2..end in cols D and E)
-    max_row = ws.max_row
-    for r in range(2, max_row + 1):
-        ws.cell(row=r, column=4, value=None)
-        ws.cell(row=r, column=5, value=None)
-    
-    # Write new minute averages starting from row 2
-    row_idx = 2
-    for minute, pressures in sorted(grouped.items()):
-        avg_pressure = sum(pressures) / len(pressures)
-        ws.cell(row=row_idx, column=4, value=minute)
-        ws.cell(row=row_idx, column=5, value=round(avg_pressure, 3))
-        row_idx += 1
-    
-    # Remove any charts before adding new one
-    ws._charts.clear()
+    logger.info(f"Loading readings from CSV file: {file_path}")
+    with open(file_path, 'rb') as f:
+        next(f, None)  # skip header
+        for line in f:
+            # Skip rows that are torn (e.g. by a power cut), hand-edited or from another day
+            ts, _, value = line.partition(b',')
+            try:
+                hour, minute, value = int(ts[11:13]), int(ts[14:16]), float(value)
+            except ValueError:
+                continue
+            if ts[:10] != minute_date_bytes or not (0 <= hour < 24 and 0 <= minute < 60):
+                continue
+            if math.isfinite(value):
+                add_reading(ts, value)
+
+def get_minute_rows(date: str, sums: array, counts: array) -> list[tuple[str, float]]:
+    """
+    Return the minute averages of one day's sums/counts as sorted (minute, average) rows.
+    Format for minute: YYYY-MM-DD HH:MM (no seconds)
+    """
+    # compress() skips the empty minutes in C; only used minutes reach the Python loop
+    return [
+        (f"{date} {MINUTE_LABELS[m]}", round(sums[m] / counts[m], 3))
+        for m in compress(range(MINUTES_PER_DAY), counts)
+    ]
+
+def write_minute_table(wb, ws, minute_rows: list):
+    """
+    Write the minute averages row by row (as constant_memory requires) and chart them.
+    Format for minute: YYYY-MM-DD HH:MM (no seconds)
+    """
+    ws.write_row(0, 0, ("Minute", "Average Pressure (bar)"))
+    for row_idx, row in enumerate(minute_rows, start=1):
+        ws.write_row(row_idx, 0, row)
+    last_row = len(minute_rows)
     
     # Create chart using minute averages
-    chart = LineChart()
-    chart.title = "Average Pressure per Minute"
-    chart.x_axis.title = "Minute"
-    chart.y_axis.title = "Pressure (bar)"
+    chart = wb.add_chart({'type': 'line'})
+    chart.set_title({'name': "Average Pressure per Minute"})
+    chart.set_x_axis({'name': "Minute"})
+    chart.set_y_axis({'name': "Pressure (bar)"})
     
-    data = Reference(ws, min_col=5, min_row=1, max_row=row_idx-1)  # avg pressure
-    cats = Reference(ws, min_col=4, min_row=2, max_row=row_idx-1)  # minute labels
-    chart.add_data(data, titles_from_data=True)
-    chart.set_categories(cats)
-    ws.add_chart(chart, "G2")  # Put chart starting at G2
+    sheet = ws.get_name()
+    chart.add_series({
+        'name': [sheet, 0, 1],
+        'categories': [sheet, 1, 0, last_row, 0],  # minute labels
+        'values': [sheet, 1, 1, last_row, 1],      # avg pressure
+    })
+    ws.insert_chart("D2", chart)  # Put chart starting at D2
 
-def read_sensor_line(serial_conn: serial.Serial) -> str:
-    """Read a single line from the UART connection."""
-    return serial_conn.readline().decode('utf-8').strip()
+def write_snapshot(count: int, csv_fds: dict[str, int], payload: bytes, excel_paths: list[str], summary: tuple):
+    """
+    Write one queued batch of readings to the CSV files, plus the Excel summary if requested.
+    `summary` is a (date, sums, counts) copy of the minute buckets, reduced here on the writer thread.
+    """
+    if count:
+        append_csv(csv_fds, payload)
+        logger.info(f"Saved {count} readings.")
+    if excel_paths:
+        save_excel(excel_paths, get_minute_rows(*summary))
+
+def writer_loop(flush_q: Queue):
+    """Background thread: write queued snapshots until a None sentinel is received."""
+    while True:
+        snapshot = flush_q.get()
+        try:
+            if snapshot is None:
+                return
+            write_snapshot(*snapshot)
+        except Exception:
+            logger.exception("Failed to save readings")
+        finally:
+            flush_q.task_done()
 
-def process_sensor_data(line: str):
+def queue_readings(flush_q: Queue, csv_fds: dict[str, int], excel_paths: list[str] = None, wait: bool = False) -> int:
+    """
+    Hand the buffered readings to the writer thread. With `excel_paths`, a copy of the
+    minute buckets is included so the day's Excel summary gets written as well.
+    Unless `wait` is set, nothing is drained while the queue is full, so readings stay
+    buffered for the next attempt. Returns the number of readings queued.
+    """
+    if not wait and flush_q.full():
+        return 0
+    count = buf_len
+    payload = drain_readings()
+    # Copies are plain memcpys; the main loop may reset the buckets right after (rollover)
+    summary = (minute_date, minute_sums[:], minute_counts[:]) if excel_paths else None
+    flush_q.put((count, csv_fds, payload, excel_paths, summary))
+    return count
+
+def write_missing_summary(day: int):
+    """
+    Write yesterday's Excel summary from its CSV if it was never written, e.g. because
+    the logger was killed or lost power before midnight.
+    """
+    date = get_previous_date()
+    csv_path = get_output_paths("csv", day, date)[0]
+    excel_paths = [path for path in get_output_paths("xlsx", day, date) if not Path(path).exists()]
+    if not excel_paths or not Path(csv_path).exists():
+        return
+    logger.info(f"Writing missing Excel summary for {date}")
+    load_minute_state(csv_path, date)
+    save_excel(excel_paths, get_minute_rows(minute_date, minute_sums, minute_counts))
+
+def handle_sigterm(signum, frame):
+    """Turn SIGTERM (systemctl stop, shutdown) into the same clean exit as Ctrl+C."""
+    raise KeyboardInterrupt
+
+def enable_low_latency(serial_conn: serial.Serial):
+    """Set ASYNC_LOW_LATENCY on the UART so lines are delivered without driver coalescing delay."""
+    try:
+        serial_conn.set_low_latency_mode(True)
+    except (AttributeError, OSError, ValueError) as e:
+        logger.warning(f"Low-latency mode not available on {serial_conn.port}: {e}")
+
+def read_sensor_line(serial_conn: serial.Serial) -> bytes:
+    """
+    Read a single raw line from the UART connection, blocking up to the port timeout.
+    The line terminator is kept: float() ignores surrounding whitespace anyway.
+    """
+    return serial_conn.readline()
+
+def process_sensor_data(line: bytes):
     """
     Validate and parse sensor data.
     Expected format: P=<value>
     Returns tuple (timestamp, float_value) if valid, otherwise None.
     """
-    if line.startswith("P="):
-        value_str = line[2:]
-        if is_float(value_str):
-            value = float(value_str)
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            return timestamp, value
-    return None
+    if not line.startswith(b"P="):
+        return None
+    try:
+        value = float(line[2:])
+    except ValueError:
+        return None
+    return (get_timestamp_bytes(), value) if math.isfinite(value) else None
 
 
 # ========================
@@ -164,87 +359,88 @@ def process_sensor_data(line: str):
 # ========================
 def main():
     logger.info("Starting UART sensor logger with minute-averaged chart...")
+    logger.info("The Excel summary is written at the end of each day and on exit.")
     logger.info("Press Ctrl+C to stop.")
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
-    current_date = time.strftime("%Y-%m-%d")
-    excel_paths = get_output_paths("xlsx")
-    csv_paths = get_output_paths("csv")
-    for path in excel_paths:
-        initialize_excel(path)
+    current_day = get_local_day()
+    next_midnight = get_next_midnight()
+    write_missing_summary(current_day)
+    excel_paths = get_output_paths("xlsx", current_day)
+    csv_paths = get_output_paths("csv", current_day)
     for path in csv_paths:
         initialize_csv(path)
-    wb, ws = load_excel(excel_paths[0])
+    load_minute_state(csv_paths[0], get_timestamp()[:10])
+    csv_fds = open_csv_fds(csv_paths)
 
     ser = serial.Serial(UART_PORT, baudrate=BAUDRATE, timeout=1)
+    enable_low_latency(ser)
+
+    # File writes happen on a separate thread so slow storage never stalls UART reads
+    flush_q = Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer = Thread(target=writer_loop, args=(flush_q,), daemon=True)
+    writer.start()
 
-    readings_buffer = []
-    last_save_time = time.time()
+    # Monotonic, so clock corrections (e.g. NTP sync after boot) cannot stall or rush saves
+    next_save = time.monotonic() + SAVE_INTERVAL
 
     try:
         while True:
-            new_date = time.strftime("%Y-%m-%d")
-
-            # Rotate files daily
-            if new_date != current_date:
-                logger.info(f"Switching to new daily logs: {new_date}")
-
-                if readings_buffer:
-                    for r in readings_buffer:
-                        ws.append(r)
-                    update_minute_averages_table(ws)
-                    for path in excel_paths:
-                        wb.save(path)
-                    for path in csv_paths:
-                        append_csv(path, readings_buffer)
-                    readings_buffer.clear()
+            line = read_sensor_line(ser)
+            data = process_sensor_data(line) if line else None
+
+            # Rotate files daily. readline() can block across midnight, so a reading decides by
+            # its own date (it must land in the day it was stamped with); otherwise use the clock
+            if data:
+                new_day = data[0][:10] != minute_date_bytes
+            else:
+                new_day = time.time() >= next_midnight
+            if new_day:
+                logger.info(f"Switching to new daily logs: {get_timestamp()[:10]}")
+
+                queue_readings(flush_q, csv_fds, excel_paths, wait=True)
+                # Let pending writes finish before their files are closed
+                flush_q.join()
                 
-                current_date = new_date
-                excel_paths = get_output_paths("xlsx")
-                csv_paths = get_output_paths("csv")
-                for path in excel_paths:
-                    initialize_excel(path)
+                current_day = get_local_day()
+                next_midnight = get_next_midnight()
+                excel_paths = get_output_paths("xlsx", current_day)
+                csv_paths = get_output_paths("csv", current_day)
                 for path in csv_paths:
                     initialize_csv(path)
-                wb, ws = load_excel(excel_paths[0])
+                load_minute_state(csv_paths[0], get_timestamp()[:10])
+                close_csv_fds(csv_fds)
+                csv_fds = open_csv_fds(csv_paths)
 
-            line = read_sensor_line(ser)
-            if line:
-                data = process_sensor_data(line)
-                if data:
-                    timestamp, value = data
-                    logger.info(f"{timestamp} -> {value:.2f} bar")
-                    readings_buffer.append(data)
-                else:
-                    logger.warning(f"Invalid data: {line}")
-
-            if time.time() - last_save_time >= SAVE_INTERVAL and readings_buffer:
-                for r in readings_buffer:
-                    ws.append(r)
-                update_minute_averages_table(ws)
-                for path in excel_paths:
-                    wb.save(path)
-                for path in csv_paths:
-                    append_csv(path, readings_buffer)
-                logger.info(f"Saved {len(readings_buffer)} readings and updated chart.")
-                readings_buffer.clear()
-                last_save_time = time.time()
+            if data:
+                timestamp, value = data
+                logger.info(f"{timestamp.decode('ascii')} -> {value:.2f} bar")
+                buffer_reading(timestamp, value)
+            elif line:
+                text = line.decode('ascii', 'replace').strip()
+                if text:
+                    logger.warning(f"Invalid data: {text}")
 
-            time.sleep(0.1)
+            # readline() returns on every line or after the 1s timeout, so no extra sleep is needed
+            if buf_len and time.monotonic() >= next_save:
+                if queue_readings(flush_q, csv_fds):
+                    next_save = time.monotonic() + SAVE_INTERVAL
+                else:
+                    logger.warning("Writer is still busy, keeping readings buffered.")
+                    next_save = time.monotonic() + 1
 
     except KeyboardInterrupt:
         logger.info("\nStopping monitoring and saving data...")
     except Exception as e:
         logger.exception(f"Unexpected error")
     finally:
-        if readings_buffer:
-            for r in readings_buffer:
-                ws.append(r)
-            update_minute_averages_table(ws)
-            for path in excel_paths:
-                wb.save(path)
-            for path in csv_paths:
-                append_csv(path, readings_buffer)
-            logger.info(f"Saved {len(readings_buffer)} readings before exit and updated chart.")
+        # Do not let a second SIGTERM interrupt the final save
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        count = queue_readings(flush_q, csv_fds, excel_paths, wait=True)
+        logger.info(f"Saving {count} readings and the Excel summary before exit...")
+        flush_q.put(None)
+        writer.join()
+        close_csv_fds(csv_fds)
         ser.close()
 
 